@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAGS_DIR = os.path.join(BASE_DIR, 'dags')
+SCRIPTS_DIR = os.path.join(DAGS_DIR, 'scripts')
+
+DAG_MODULE = 'monthly_similarity_processing_dag'
+# Airflow modules imported by the DAG file; their cost is not attributed to our code
+AIRFLOW_MODULES = [
+    'airflow',
+    'airflow.operators.email',
+    'airflow.operators.empty',
+    'airflow.operators.python',
+    'airflow.providers.amazon.aws.sensors.s3',
+]
+HEAVY_MODULES = ['pandas', 'pyarrow', 'numpy', 'rdkit', 'sqlmodel', 'boto3', 'aiohttp']
+
+PROBE = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def measure(modules, runs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [SCRIPTS_DIR, DAGS_DIR, env.get('PYTHONPATH')]))
+    timings = []
+    loaded = set()
+
+    for _ in range(runs):
+        # A fresh interpreter per run so nothing is already in sys.modules
+        output = subprocess.run([sys.executable, '-c', PROBE.format(modules=modules, heavy=HEAVY_MODULES)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded.update(result['loaded'])
+
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how long parsing the monthly similarity DAG takes.')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters per measurement')
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='maximum seconds the DAG may add on top of importing Airflow itself')
+    args = parser.parse_args()
+
+    airflow_seconds, airflow_loaded = measure(AIRFLOW_MODULES, args.runs)
+    dag_seconds, dag_loaded = measure(AIRFLOW_MODULES + [DAG_MODULE], args.runs)
+    overhead = dag_seconds - airflow_seconds
+    extra_heavy = sorted(dag_loaded - airflow_loaded)
+
+    print(f'Airflow imports:   {airflow_seconds:.3f}s')
+    print(f'DAG import:        {dag_seconds:.3f}s')
+    print(f'DAG overhead:      {overhead:.3f}s (budget {args.budget:.3f}s)')
+    print(f'Heavy modules loaded by the DAG: {", ".join(extra_heavy) or "none"}')
+
+    if overhead > args.budget or extra_heavy:
+        print('DAG parse time budget exceeded')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
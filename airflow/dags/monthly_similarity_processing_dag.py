@@ -1,3 +1,5 @@
+import logging
+
 import pendulum
 from airflow.operators.email import EmailOperator
 from airflow.operators.empty import EmptyOperator
@@ -6,14 +8,23 @@ from airflow.providers.amazon.aws.sensors.s3 import S3KeySensor
 
 from airflow import DAG
 from config import CONFIG
-from tanimoto_similarity_processor import TanimotoSimilarityProcessor
 
 config = CONFIG.get_fingerprint_similarity_config()
 
 
-def compute_similarity(file_key):
+def compute_similarity(file_key, load_month):
+    # Imported inside the task so that parsing the DAG does not load pandas, pyarrow, RDKit, sqlmodel or boto3
+    from exceptions import SimilarityServiceError
+    from tanimoto_similarity_processor import TanimotoSimilarityProcessor
+
     processor = TanimotoSimilarityProcessor()
-    processor.compute_and_store_similarity(file_key)
+    if config['service']['enabled']:
+        try:
+            processor.compute_and_store_similarity_from_service(file_key, load_month)
+            return
+        except SimilarityServiceError as e:
+            logging.warning(f'{e}; falling back to scanning the fingerprint shards')
+    processor.compute_and_store_similarity(file_key, load_month)
 
 
 def send_failure_notification(context):
@@ -51,7 +62,8 @@ with DAG(
     compute_similarity_op = PythonOperator(
         task_id="compute_similarity",
         python_callable=compute_similarity,
-        op_args=[f"{config['input_prefix']}data_{{{{ execution_date.strftime('%m_%Y') }}}}.csv"]
+        op_args=[f"{config['input_prefix']}data_{{{{ execution_date.strftime('%m_%Y') }}}}.csv",
+                 "{{ execution_date.strftime('%Y-%m-01') }}"]
     )
 
     finish_op = EmptyOperator(task_id="finish")
@@ -1,4 +1,5 @@
-import boto3
+from functools import lru_cache
+
 from config import CONFIG
 
 
@@ -12,6 +13,8 @@ class AWS:
         self.boto_client = self.create_boto_client()
 
     def create_boto_client(self):
+        import boto3
+
         return boto3.client(
             's3',
             aws_access_key_id=self.aws_access_key_id,
@@ -19,3 +22,9 @@ class AWS:
             aws_session_token=self.aws_session_token,
             region_name=self.aws_region
         )
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """S3 client shared by everything running in this process, created on first use."""
+    return AWS().boto_client
@@ -12,7 +12,7 @@ from sqlmodel import text
 from tqdm.asyncio import tqdm
 
 from config import CONFIG
-from db import Database
+from db import get_engine
 from models import ChemblIdLookup
 from models import CompoundProperties
 from models import CompoundStructures
@@ -24,12 +24,17 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(me
 
 
 class ChemblDataIngestor:
-    def __init__(self):
+    def __init__(self, fused_fingerprints=None):
         self.api_config = CONFIG.get_api_config()
         self.semaphore = asyncio.Semaphore(self.api_config['concurrent_requests'])
-        self.database = Database()
-        self.engine = self.database.engine
+        self.engine = get_engine()
         self.model_mapping = CONFIG.get_model_mapping()
+        if fused_fingerprints is None:
+            fused_fingerprints = CONFIG.get_fingerprint_similarity_config()['fingerprints']['fused_ingest']
+        self.fused_fingerprints = fused_fingerprints
+        self.fingerprint_pipeline = None
+        # Set when any page is lost, so a partial ingest does not publish a fingerprint library
+        self.failed = False
 
     async def load_and_validate_data(self, session, url, json, model):
         retries = self.api_config['retries']
@@ -76,6 +81,7 @@ class ChemblDataIngestor:
                                     pbar.update(1)
                                 except Exception as e:
                                     logging.error(f"Error loading and validating data: {e}")
+                                    self.failed = True
 
                         await self.process_and_insert_data(all_data, model)
                         all_data = []
@@ -85,6 +91,7 @@ class ChemblDataIngestor:
                     await self.process_and_insert_data(all_data, model)
             except Exception as e:
                 logging.error(f"An error occurred while loading data for {model.__name__}: {e}")
+                self.failed = True
             finally:
                 await session.close()
 
@@ -111,6 +118,10 @@ class ChemblDataIngestor:
                 tasks = [process_item(item) for item in data]
                 await asyncio.gather(*tasks)
 
+                # Fingerprint the page in the background while it is written to staging
+                if self.fingerprint_pipeline:
+                    self.fingerprint_pipeline.submit(compound_structures)
+
                 await self.insert_individual_data(molecule_dicts, MoleculeDictionary)
                 await self.insert_individual_data(compound_properties, CompoundProperties)
                 await self.insert_individual_data(compound_structures, CompoundStructures)
@@ -118,6 +129,7 @@ class ChemblDataIngestor:
                 await self.insert_individual_data([item.model_dump() for item in data], model)
         except Exception as e:
             logging.error(f"An error occurred during data processing and insertion for {model.__tablename__}: {e}")
+            self.failed = True
         finally:
             del data
             gc.collect()
@@ -136,6 +148,7 @@ class ChemblDataIngestor:
             logging.info(f"Data successfully inserted into the database for {model.__tablename__}")
         except Exception as e:
             logging.error(f"An error occurred while inserting data into {model.__tablename__}: {e}")
+            self.failed = True
         finally:
             del df
             del data
@@ -151,6 +164,7 @@ class ChemblDataIngestor:
 
     async def run(self):
         logging.info("Starting the main function")
+        completed = False
 
         try:
             await self.truncate_table(ChemblIdLookup)
@@ -158,6 +172,13 @@ class ChemblDataIngestor:
             await self.truncate_table(CompoundProperties)
             await self.truncate_table(CompoundStructures)
 
+            if self.fused_fingerprints:
+                # RDKit and pyarrow are only needed in fused mode
+                from fused_fingerprint_pipeline import FusedFingerprintPipeline
+
+                logging.info("Fused mode: fingerprints are computed while molecules are ingested")
+                self.fingerprint_pipeline = FusedFingerprintPipeline()
+
             for key, value in CONFIG.get_chembl_config().items():
                 file = value['file']
                 params = value['params']
@@ -165,9 +186,14 @@ class ChemblDataIngestor:
                 model_name = self.model_mapping[key]
                 model = globals()[model_name]
                 await self.load_all_data(file, params, json, model)
+            completed = True
         except Exception as e:
             logging.error(f"An error occurred in the run method: {e}")
         finally:
+            if self.fingerprint_pipeline:
+                publish = completed and not self.failed
+                await asyncio.get_running_loop().run_in_executor(None, self.fingerprint_pipeline.finish, publish)
+                self.fingerprint_pipeline = None
             logging.info("Finished the main function")
 
 
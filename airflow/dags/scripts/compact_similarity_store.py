@@ -0,0 +1,255 @@
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import CONFIG
+
+
+class CompactSimilarityStore:
+    """Compact storage for per-target similarity scores.
+
+    All targets of a run are streamed into one dataset sorted by target_chembl_id and split into a
+    few large part files, so a target can be located through row group statistics. Scores are
+    quantised to uint16 and library molecules are stored as int32 row indices into the fan-out
+    table of the fingerprint library, which is written with the same version as ID dictionary:
+
+        <prefix>compact/<run_name>/LATEST                                   (current version)
+        <prefix>compact/<run_name>/<version>/chembl_id_dictionary.parquet
+        <prefix>compact/<run_name>/<version>/scores/part-<n>.parquet
+
+    Targets are appended one group at a time with start(), append() and publish(). publish()
+    switches LATEST once every part has been uploaded and then removes all versions but the current
+    and the previous one, so readers never mix parts or dictionaries of different runs.
+    """
+    SCORE_SCALE = np.iinfo(np.uint16).max
+    DICTIONARY_FILE = 'chembl_id_dictionary.parquet'
+    SCORES_DIR = 'scores'
+    POINTER_FILE = 'LATEST'
+    SCHEMA = pa.schema([
+        ('row_index', pa.int32()),
+        ('tanimoto_similarity_score', pa.uint16()),
+        ('target_chembl_id', pa.string()),
+    ])
+
+    def __init__(self, s3, bucket_name):
+        config = CONFIG.get_fingerprint_similarity_config()['similarities']
+        compact_config = config['compact']
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.prefix = f"{config['similarities_prefix']}compact/"
+        self.threshold = compact_config['threshold']
+        self.top_n = compact_config['top_n']
+        self.rows_per_file = compact_config['rows_per_file']
+        self.row_group_size = compact_config['row_group_size']
+        self.run_name = None
+        self.version = None
+        self.version_prefix = None
+        self.local_dir = None
+        self.library_rows = None
+        self.writer = None
+        self.part = 0
+        self.part_rows = 0
+        self.buffer = []
+        self.buffered_rows = 0
+        self.total_rows = 0
+        self.published = False
+
+    @classmethod
+    def quantize_scores(cls, scores):
+        return np.rint(np.clip(scores, 0.0, 1.0) * cls.SCORE_SCALE).astype(np.uint16)
+
+    @classmethod
+    def dequantize_scores(cls, scores):
+        return scores.astype(np.float64) / cls.SCORE_SCALE
+
+    def run_prefix(self, run_name):
+        return f'{self.prefix}{run_name}/'
+
+    def read_pointer(self, run_name):
+        try:
+            pointer = self.s3.get_object(Bucket=self.bucket_name, Key=f'{self.run_prefix(run_name)}{self.POINTER_FILE}')
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return pointer['Body'].read().decode('utf-8').strip()
+
+    def upload_file(self, local_path, name):
+        self.s3.upload_file(local_path, self.bucket_name, f'{self.version_prefix}{name}')
+        os.remove(local_path)
+
+    def start(self, run_name, fingerprint_ids):
+        """Begin a new version of the run; the row order of the fan-out table is the ID dictionary."""
+        self.run_name = run_name
+        self.version = f"{datetime.utcnow():%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+        self.version_prefix = f'{self.run_prefix(run_name)}{self.version}/'
+        self.local_dir = tempfile.mkdtemp(prefix='compact_similarities_')
+        row_index = np.arange(len(fingerprint_ids), dtype=np.int32)
+        self.library_rows = pd.DataFrame({'fingerprint_id': fingerprint_ids['fingerprint_id'].to_numpy(),
+                                          'row_index': row_index})
+
+        local_path = os.path.join(self.local_dir, self.DICTIONARY_FILE)
+        pq.write_table(pa.table({
+            'row_index': pa.array(row_index),
+            'chembl_id': pa.array(fingerprint_ids['chembl_id'].astype(str).to_numpy()),
+        }), local_path, compression='zstd')
+        self.upload_file(local_path, self.DICTIONARY_FILE)
+
+    def append(self, target_chembl_id, group):
+        """Add the unique fingerprint scores of one target, expanded to every library molecule.
+
+        Targets must be appended in ascending target_chembl_id order.
+        """
+        df = group[['fingerprint_id', 'tanimoto_similarity_score']]
+        if self.threshold is not None:
+            df = df[df['tanimoto_similarity_score'] >= self.threshold]
+        df = df.merge(self.library_rows, on='fingerprint_id')
+        if self.top_n is not None:
+            df = df.sort_values('tanimoto_similarity_score', ascending=False, kind='stable').head(self.top_n)
+
+        self.buffer.append(pa.table({
+            'row_index': pa.array(df['row_index'].to_numpy()),
+            'tanimoto_similarity_score': pa.array(self.quantize_scores(df['tanimoto_similarity_score'].to_numpy())),
+            'target_chembl_id': pa.array([str(target_chembl_id)] * len(df), type=pa.string()),
+        }, schema=self.SCHEMA))
+        self.buffered_rows += len(df)
+        self.total_rows += len(df)
+        if self.buffered_rows >= self.row_group_size:
+            self.write_row_groups()
+
+    def write_row_groups(self, final=False):
+        """Write the buffered rows as full row groups, rolling to a new part file every rows_per_file rows."""
+        if not self.buffer:
+            return
+        table = pa.concat_tables(self.buffer)
+        full = table.num_rows if final else table.num_rows - table.num_rows % self.row_group_size
+        for start in range(0, full, self.row_group_size):
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(os.path.join(self.local_dir, f'part-{self.part}.parquet'),
+                                               self.SCHEMA, compression='zstd')
+            row_group = table.slice(start, min(self.row_group_size, full - start))
+            self.writer.write_table(row_group, row_group_size=self.row_group_size)
+            self.part_rows += row_group.num_rows
+            if self.part_rows >= self.rows_per_file:
+                self.close_part()
+
+        rest = table.slice(full)
+        self.buffer = [rest] if rest.num_rows else []
+        self.buffered_rows = rest.num_rows
+
+    def close_part(self):
+        self.writer.close()
+        self.writer = None
+        self.upload_file(os.path.join(self.local_dir, f'part-{self.part}.parquet'),
+                         f'{self.SCORES_DIR}/part-{self.part}.parquet')
+        self.part += 1
+        self.part_rows = 0
+
+    def publish(self):
+        """Upload the remaining rows, point LATEST at this version and drop all but the previous version."""
+        self.write_row_groups(final=True)
+        if self.writer is not None:
+            self.close_part()
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+        previous = self.read_pointer(self.run_name)
+        self.s3.put_object(Bucket=self.bucket_name, Key=f'{self.run_prefix(self.run_name)}{self.POINTER_FILE}',
+                           Body=self.version.encode('utf-8'))
+        self.published = True
+        logging.info(f'Compact similarity dataset uploaded to S3: {self.version_prefix} '
+                     f'({self.total_rows} scores, {len(self.library_rows)} molecules, {self.part} part files)')
+
+        # The previous version is kept for readers that resolved LATEST before the switch
+        self.remove_old_versions(self.run_name, [self.version] + ([previous] if previous else []))
+
+    def discard(self):
+        """Delete this version's uploaded files; the published version is left untouched."""
+        if self.published or self.version_prefix is None:
+            return
+        try:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.version_prefix):
+                for file in page.get('Contents', []):
+                    self.s3.delete_object(Bucket=self.bucket_name, Key=file['Key'])
+            logging.info(f'Discarded unpublished compact similarity version {self.version_prefix}')
+        except Exception as e:
+            logging.error(f'An error occurred while discarding compact similarity version {self.version_prefix}: {e}')
+
+    def remove_old_versions(self, run_name, keep_versions):
+        run_prefix = self.run_prefix(run_name)
+        keep = tuple(f'{run_prefix}{version}/' for version in keep_versions) + (f'{run_prefix}{self.POINTER_FILE}',)
+        stale_keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=run_prefix):
+            stale_keys.extend(file['Key'] for file in page.get('Contents', []) if not file['Key'].startswith(keep))
+
+        for start in range(0, len(stale_keys), 1000):
+            self.s3.delete_objects(Bucket=self.bucket_name, Delete={
+                'Objects': [{'Key': key} for key in stale_keys[start:start + 1000]]})
+        if stale_keys:
+            logging.info(f'Removed {len(stale_keys)} objects of older versions under {run_prefix}')
+
+    def read_parquet_file(self, key):
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        return pq.ParquetFile(pa.BufferReader(obj['Body'].read()))
+
+    @staticmethod
+    def matching_row_groups(parquet_file, target_chembl_ids):
+        """Row groups whose target_chembl_id min/max statistics can contain one of the targets."""
+        if target_chembl_ids is None:
+            return list(range(parquet_file.num_row_groups))
+
+        column = parquet_file.schema_arrow.get_field_index('target_chembl_id')
+        row_groups = []
+        for i in range(parquet_file.num_row_groups):
+            statistics = parquet_file.metadata.row_group(i).column(column).statistics
+            if statistics is None or not statistics.has_min_max or any(
+                    statistics.min <= target <= statistics.max for target in target_chembl_ids):
+                row_groups.append(i)
+        return row_groups
+
+    def read(self, run_name, target_chembl_ids=None):
+        """Reconstruct the per-target similarity schema (chembl_id, tanimoto_similarity_score, target_chembl_id)."""
+        version = self.read_pointer(run_name)
+        if version is None:
+            logging.warning(f'No compact similarity dataset has been published for {run_name}')
+            return pd.DataFrame(columns=['chembl_id', 'tanimoto_similarity_score', 'target_chembl_id'])
+        version_prefix = f'{self.run_prefix(run_name)}{version}/'
+
+        chembl_ids = self.read_parquet_file(f'{version_prefix}{self.DICTIONARY_FILE}').read() \
+            .to_pandas().sort_values('row_index')['chembl_id'].to_numpy()
+        if target_chembl_ids is not None:
+            target_chembl_ids = set(target_chembl_ids)
+
+        paginator = self.s3.get_paginator('list_objects_v2')
+        results = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=f'{version_prefix}{self.SCORES_DIR}/'):
+            for file in page.get('Contents', []):
+                parquet_file = self.read_parquet_file(file['Key'])
+                row_groups = self.matching_row_groups(parquet_file, target_chembl_ids)
+                if not row_groups:
+                    continue
+
+                scores = parquet_file.read_row_groups(row_groups).to_pandas()
+                if target_chembl_ids is not None:
+                    scores = scores[scores['target_chembl_id'].isin(target_chembl_ids)]
+                results.append(pd.DataFrame({
+                    'chembl_id': chembl_ids[scores['row_index'].to_numpy()],
+                    'tanimoto_similarity_score': self.dequantize_scores(
+                        scores['tanimoto_similarity_score'].to_numpy()),
+                    'target_chembl_id': scores['target_chembl_id'].to_numpy(),
+                }))
+
+        if not results:
+            return pd.DataFrame(columns=['chembl_id', 'tanimoto_similarity_score', 'target_chembl_id'])
+        return pd.concat(results, ignore_index=True)
@@ -7,7 +7,15 @@ class Config:
         if config_file is None:
             base_dir = os.path.dirname(os.path.abspath(__file__))
             config_file = os.path.join(base_dir, 'config.yaml')
-        self.config = self.load_config(config_file)
+        self.config_file = config_file
+        self._config = None
+
+    @property
+    def config(self):
+        # Loaded on first access and cached for the lifetime of the process
+        if self._config is None:
+            self._config = self.load_config(self.config_file)
+        return self._config
 
     @staticmethod
     def load_config(config_file):
@@ -1,4 +1,5 @@
-from sqlmodel import create_engine
+from functools import lru_cache
+
 from config import CONFIG
 
 
@@ -13,5 +14,13 @@ class Database:
         self.engine = self.create_engine()
 
     def create_engine(self):
+        from sqlmodel import create_engine
+
         url = f"postgresql+psycopg2://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
         return create_engine(url, echo=False)
+
+
+@lru_cache(maxsize=None)
+def get_engine():
+    """Database engine shared by everything running in this process, created on first use."""
+    return Database().engine
@@ -11,25 +11,32 @@ CREATE TABLE IF NOT EXISTS dim_molecules (
     heavy_atoms INT4
 );
 
+-- One partition per load month (fact_molecule_similarities_YYYY_MM). The monthly job bulk-loads
+-- a standalone table, indexes it and attaches it, replacing the month's previous partition.
+-- The same (source, target) pair can appear in several months, so every view below is per load_month.
 CREATE TABLE IF NOT EXISTS fact_molecule_similarities (
+    load_month DATE NOT NULL,
     source_chembl_id VARCHAR(20) REFERENCES dim_molecules(chembl_id),
     target_chembl_id VARCHAR(20) REFERENCES dim_molecules(chembl_id),
     tanimoto_similarity_score NUMERIC(9, 6),
     has_duplicates_of_last_largest_score BOOLEAN,
-    PRIMARY KEY (source_chembl_id, target_chembl_id)
-);
+    PRIMARY KEY (load_month, source_chembl_id, target_chembl_id)
+) PARTITION BY RANGE (load_month);
 
 CREATE OR REPLACE VIEW avg_similarity_per_source AS
 SELECT
+    fms.load_month,
     fms.source_chembl_id,
     AVG(fms.tanimoto_similarity_score) AS avg_similarity_score
 FROM
     fact_molecule_similarities fms
 GROUP BY
+    fms.load_month,
     fms.source_chembl_id;
 
 CREATE OR REPLACE VIEW avg_alogp_deviation AS
 SELECT
+    fms.load_month,
     fms.source_chembl_id,
     AVG(ABS(dm1.alogp - dm2.alogp)) AS avg_alogp_deviation
 FROM
@@ -39,6 +46,7 @@ JOIN
 JOIN
     dim_molecules dm2 ON fms.target_chembl_id = dm2.chembl_id
 GROUP BY
+    fms.load_month,
     fms.source_chembl_id;
 
 CREATE OR REPLACE VIEW next_most_similar AS
@@ -47,12 +55,14 @@ WITH ranked_similarities AS (
         fms.source_chembl_id,
         fms.target_chembl_id,
         fms.tanimoto_similarity_score,
-        LEAD(fms.target_chembl_id, 1) OVER (PARTITION BY fms.source_chembl_id ORDER BY fms.tanimoto_similarity_score DESC) AS next_most_similar,
-        LEAD(fms.target_chembl_id, 2) OVER (PARTITION BY fms.source_chembl_id ORDER BY fms.tanimoto_similarity_score DESC) AS second_most_similar
+        fms.load_month,
+        LEAD(fms.target_chembl_id, 1) OVER (PARTITION BY fms.load_month, fms.source_chembl_id ORDER BY fms.tanimoto_similarity_score DESC) AS next_most_similar,
+        LEAD(fms.target_chembl_id, 2) OVER (PARTITION BY fms.load_month, fms.source_chembl_id ORDER BY fms.tanimoto_similarity_score DESC) AS second_most_similar
     FROM
         fact_molecule_similarities fms
 )
 SELECT
+    load_month,
     source_chembl_id,
     target_chembl_id,
     tanimoto_similarity_score,
@@ -63,6 +73,7 @@ FROM
 
 CREATE OR REPLACE VIEW avg_similarity_score_categories AS
 SELECT
+    fms.load_month,
     CASE
         WHEN GROUPING(fms.source_chembl_id) = 1 AND GROUPING(dm.aromatic_rings) = 1 AND GROUPING(dm.heavy_atoms) = 1 THEN 'TOTAL'
         ELSE fms.source_chembl_id
@@ -82,8 +93,8 @@ JOIN
     dim_molecules dm ON fms.source_chembl_id = dm.chembl_id
 GROUP BY
     GROUPING SETS (
-        (fms.source_chembl_id),
-        (dm.aromatic_rings, dm.heavy_atoms),
-        (dm.heavy_atoms),
-        ()
+        (fms.load_month, fms.source_chembl_id),
+        (fms.load_month, dm.aromatic_rings, dm.heavy_atoms),
+        (fms.load_month, dm.heavy_atoms),
+        (fms.load_month)
     );
@@ -12,3 +12,8 @@ class EmptySMILESError(SMILESParsingError):
 class InvalidSMILESError(SMILESParsingError):
     """Raised for invalid SMILES strings"""
     pass
+
+
+class SimilarityServiceError(Exception):
+    """Raised when the similarity query service cannot answer a request"""
+    pass
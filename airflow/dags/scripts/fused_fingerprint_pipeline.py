@@ -0,0 +1,88 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+import pandas as pd
+
+from morgan_fingerprint_calculator import MorganFingerprintCalculator
+from morgan_fingerprint_processor import MorganFingerprintProcessor
+
+
+class FusedFingerprintPipeline:
+    """Fingerprints molecule pages while they are still being ingested.
+
+    Compound structures are handed over page by page; SMILES not seen before are buffered into
+    chunks and fingerprinted in a process pool. Finished chunks are deduplicated and uploaded to S3
+    by a single background thread, so neither step blocks the ingestion event loop.
+
+    Shards are written under a new library version that is only published by finish() after a
+    successful ingest; until then the service and the DAG keep reading the previous version.
+    """
+
+    def __init__(self):
+        self.processor = MorganFingerprintProcessor()
+        self.chunk_size = self.processor.chunk_size
+        self.pool = ProcessPoolExecutor(max_workers=max(cpu_count() // 2, 1))
+        self.uploader = ThreadPoolExecutor(max_workers=1)
+        self.structures = []
+        self.seen_smiles = set()
+        self.pending_smiles = []
+        self.batch_num = 0
+
+    def submit(self, compound_structures):
+        if not compound_structures:
+            return
+
+        df = pd.DataFrame(compound_structures)[['chembl_id', 'canonical_smiles']]
+        self.structures.append(df)
+
+        for smiles in df['canonical_smiles'].drop_duplicates():
+            if smiles not in self.seen_smiles:
+                self.seen_smiles.add(smiles)
+                self.pending_smiles.append(smiles)
+
+        while len(self.pending_smiles) >= self.chunk_size:
+            self.submit_chunk(self.pending_smiles[:self.chunk_size])
+            self.pending_smiles = self.pending_smiles[self.chunk_size:]
+
+    def submit_chunk(self, smiles_list):
+        batch_num = self.batch_num
+        self.batch_num += 1
+        logging.info(f'Submitting fingerprint batch {batch_num} ({len(smiles_list)} SMILES)')
+
+        future = self.pool.submit(MorganFingerprintCalculator.process_fingerprints,
+                                  pd.DataFrame({'canonical_smiles': smiles_list}))
+        future.add_done_callback(lambda done: self.uploader.submit(self.store_batch, done, batch_num))
+
+    def store_batch(self, future, batch_num):
+        try:
+            self.processor.store_fingerprint_batch(future.result(), batch_num)
+        except Exception as e:
+            logging.error(f'An error occurred while fingerprinting batch {batch_num}: {e}')
+            self.processor.failed_batches.append(batch_num)
+
+    def finish(self, publish=True):
+        try:
+            if publish and self.pending_smiles:
+                self.submit_chunk(self.pending_smiles)
+                self.pending_smiles = []
+
+            # Waiting for the pool also runs the callbacks that queue the last uploads
+            self.pool.shutdown(wait=True)
+            self.uploader.shutdown(wait=True)
+
+            if not publish or not self.structures:
+                logging.warning(f'Ingestion did not complete, fingerprint library version '
+                                f'{self.processor.version} is discarded')
+                self.processor.discard()
+                return
+
+            self.processor.store_fingerprint_ids(pd.concat(self.structures, ignore_index=True))
+            logging.info(f'Fused fingerprinting finished: {self.batch_num} batches')
+        except Exception as e:
+            logging.error(f'An error occurred while finishing fused fingerprinting: {e}')
+            self.processor.discard()
+        finally:
+            self.pool.shutdown(wait=False)
+            self.uploader.shutdown(wait=False)
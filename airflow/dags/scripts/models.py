@@ -1,3 +1,4 @@
+from datetime import date
 from typing import Optional
 from sqlmodel import SQLModel, Field
 
@@ -89,6 +90,7 @@ class DimMolecules(SQLModel, table=True):
 
 class FactMoleculeSimilarities(SQLModel, table=True):
     __tablename__ = 'fact_molecule_similarities'
+    load_month: date = Field(primary_key=True)
     source_chembl_id: str = Field(foreign_key="dim_molecules.chembl_id", max_length=20, primary_key=True)
     target_chembl_id: str = Field(foreign_key="dim_molecules.chembl_id", max_length=20, primary_key=True)
     tanimoto_similarity_score: Optional[float] = Field(default=None)
@@ -43,9 +43,11 @@ class MorganFingerprintCalculator:
             raise ValueError("The 'canonical_smiles' column is missing from the DataFrame.")
 
         try:
+            # Identical SMILES (e.g. salts stripped to the same parent) are parsed only once
+            df_part = df_part[['canonical_smiles']].drop_duplicates().copy()
             smiles_list = df_part['canonical_smiles'].tolist()
             df_part['morgan_fingerprint'] = [cls.calculate_morgan_fingerprint(smiles) for smiles in tqdm(smiles_list)]
-            df_filtered = df_part[df_part['morgan_fingerprint'].notnull()][['chembl_id', 'morgan_fingerprint']]
+            df_filtered = df_part[df_part['morgan_fingerprint'].notnull()]
             return df_filtered
         except Exception as e:
             logging.error(f"An error occurred during fingerprint processing: {e}")
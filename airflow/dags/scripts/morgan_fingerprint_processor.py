@@ -1,6 +1,10 @@
 import gc
+import hashlib
+import json
 import logging
 import os
+import uuid
+from datetime import datetime
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 
@@ -10,22 +14,129 @@ import pyarrow.parquet as pq
 from sqlmodel import Session
 from sqlmodel import select
 
-from aws import AWS
+from aws import get_s3_client
 from config import CONFIG
-from db import Database
+from db import get_engine
 from models import CompoundStructures
 from morgan_fingerprint_calculator import MorganFingerprintCalculator
 
 
 class MorganFingerprintProcessor:
     def __init__(self):
-        self.database = Database()
-        self.engine = self.database.engine
-        self.aws = AWS()
+        self.engine = get_engine()
+        self.s3 = get_s3_client()
         self.fingerprints_config = CONFIG.get_fingerprint_similarity_config()
         self.bucket_name = self.fingerprints_config['bucket_name']
         self.fingerprints_prefix = self.fingerprints_config['fingerprints']['fingerprints_prefix']
         self.chunk_size = self.fingerprints_config['fingerprints']['chunk_size']
+        self.manifest_key = self.fingerprints_config['fingerprints']['manifest_key']
+        # Every run writes a new version; readers only see it once the manifest points to it
+        self.version = f"{datetime.utcnow():%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+        self.version_prefix = f'{self.fingerprints_prefix}{self.version}/'
+        self.fingerprint_ids = {}
+        self.smiles_fingerprint_ids = {}
+        self.written_keys = set()
+        self.failed_batches = []
+        self.published = False
+
+    @staticmethod
+    def assign_fingerprint_ids(df_part, fingerprint_ids, smiles_fingerprint_ids):
+        """Map every SMILES to a fingerprint id and return the fingerprints seen for the first time."""
+        new_rows = []
+        for smiles, fingerprint in zip(df_part['canonical_smiles'], df_part['morgan_fingerprint']):
+            digest = hashlib.blake2b(fingerprint.encode('ascii'), digest_size=16).digest()
+            fingerprint_id = fingerprint_ids.get(digest)
+            if fingerprint_id is None:
+                fingerprint_id = fingerprint_ids[digest] = len(fingerprint_ids)
+                new_rows.append((fingerprint_id, fingerprint))
+            smiles_fingerprint_ids[smiles] = fingerprint_id
+        return pd.DataFrame(new_rows, columns=['fingerprint_id', 'morgan_fingerprint'])
+
+    def upload_table(self, df, s3_path):
+        file_name = os.path.basename(s3_path)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, file_name, compression='zstd')
+        self.s3.upload_file(file_name, self.bucket_name, s3_path)
+        logging.info(f'File uploaded to S3: {s3_path}')
+        os.remove(file_name)
+
+    @staticmethod
+    def read_manifest(s3, bucket_name, manifest_key):
+        """Currently published fingerprint library: its version, shard keys and fan-out table key."""
+        try:
+            manifest_obj = s3.get_object(Bucket=bucket_name, Key=manifest_key)
+        except s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(manifest_obj['Body'].read())
+
+    def remove_old_versions(self, keep_versions):
+        keep = tuple(f'{self.fingerprints_prefix}{version}/' for version in keep_versions) + (self.manifest_key,)
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.fingerprints_prefix):
+            for file in page.get('Contents', []):
+                if not file['Key'].startswith(keep):
+                    self.s3.delete_object(Bucket=self.bucket_name, Key=file['Key'])
+                    logging.info(f'Removed old fingerprint library object from S3: {file["Key"]}')
+
+    def discard(self):
+        """Delete this run's unpublished shards; the published library is left untouched."""
+        if self.published:
+            return
+        try:
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.version_prefix):
+                for file in page.get('Contents', []):
+                    self.s3.delete_object(Bucket=self.bucket_name, Key=file['Key'])
+            logging.info(f'Discarded unpublished fingerprint library version {self.version}')
+        except Exception as e:
+            logging.error(f'An error occurred while discarding fingerprint library version {self.version}: {e}')
+
+    def publish(self, fingerprint_ids_key):
+        """Point the manifest at this run's shards and fan-out table, then drop all but the previous version."""
+        previous = self.read_manifest(self.s3, self.bucket_name, self.manifest_key)
+        manifest = {
+            'version': self.version,
+            'shards': sorted(self.written_keys),
+            'fingerprint_ids': fingerprint_ids_key,
+            'fingerprints': len(self.fingerprint_ids),
+        }
+        self.s3.put_object(Bucket=self.bucket_name, Key=self.manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+        self.published = True
+        logging.info(f'Fingerprint library version {self.version} published: {len(self.written_keys)} shards')
+
+        # The previous version is kept for readers that loaded its manifest before the switch
+        self.remove_old_versions([self.version] + ([previous['version']] if previous else []))
+
+    def store_fingerprint_batch(self, df_part, batch_num):
+        logging.info(f'Processing and saving batch {batch_num}')
+
+        # Save only fingerprints that were not produced by an earlier SMILES
+        try:
+            unique_df = self.assign_fingerprint_ids(df_part, self.fingerprint_ids, self.smiles_fingerprint_ids)
+            if unique_df.empty:
+                return
+            s3_path = f'{self.version_prefix}compound_fingerprints_{batch_num}.parquet'
+            self.upload_table(unique_df, s3_path)
+            self.written_keys.add(s3_path)
+            del df_part
+            del unique_df
+        except Exception as e:
+            logging.error(f'An error occurred while saving batch {batch_num}: {e}')
+            self.failed_batches.append(batch_num)
+
+    def store_fingerprint_ids(self, df):
+        if self.failed_batches:
+            raise RuntimeError(f'Fingerprint library version {self.version} is incomplete, batches '
+                               f'{sorted(self.failed_batches)} failed; keeping the published version')
+        logging.info(f'Unique fingerprints: {len(self.fingerprint_ids)} for {len(df)} molecules')
+
+        fanout_df = df[['chembl_id']].copy()
+        fanout_df['fingerprint_id'] = df['canonical_smiles'].map(self.smiles_fingerprint_ids)
+        fanout_df = fanout_df[fanout_df['fingerprint_id'].notnull()]
+        fanout_df['fingerprint_id'] = fanout_df['fingerprint_id'].astype('int64')
+        fingerprint_ids_key = f'{self.version_prefix}compound_fingerprint_ids.parquet'
+        self.upload_table(fanout_df, fingerprint_ids_key)
+        self.publish(fingerprint_ids_key)
 
     def compute_and_store_fingerprints(self):
         try:
@@ -42,32 +153,19 @@ class MorganFingerprintProcessor:
                 # Convert SQLModel objects to dictionaries
                 data = [row.model_dump() for row in results]
 
-                df = pd.DataFrame(data)
-                logging.info(f'Total records read: {len(df)}')
-
-                num_batches = (len(df) + self.chunk_size - 1) // self.chunk_size
-                df_splits = [df[i * self.chunk_size:(i + 1) * self.chunk_size] for i in range(num_batches)]
-
-                with Pool(cpu_count() // 2) as pool:
-                    for batch_num, df_part in enumerate(
-                            pool.imap(MorganFingerprintCalculator.process_fingerprints, df_splits)):
-                        logging.info(f'Processing and saving batch {batch_num}')
+            df = pd.DataFrame(data)
+            smiles_df = df[['canonical_smiles']].drop_duplicates()
+            logging.info(f'Total records read: {len(df)}, unique SMILES: {len(smiles_df)}')
 
-                        # Save to S3
-                        try:
-                            table = pa.Table.from_pandas(df_part)
-                            file_name = f'compound_fingerprints_{batch_num}.parquet'
-                            pq.write_table(table, file_name, compression='zstd')
+            num_batches = (len(smiles_df) + self.chunk_size - 1) // self.chunk_size
+            df_splits = [smiles_df[i * self.chunk_size:(i + 1) * self.chunk_size] for i in range(num_batches)]
 
-                            s3_path = f'{self.fingerprints_prefix}compound_fingerprints_{batch_num}.parquet'
-                            self.aws.boto_client.upload_file(file_name, self.bucket_name, s3_path)
-                            logging.info(f'File uploaded to S3: {s3_path}')
+            with Pool(cpu_count() // 2) as pool:
+                for batch_num, df_part in enumerate(
+                        pool.imap(MorganFingerprintCalculator.process_fingerprints, df_splits)):
+                    self.store_fingerprint_batch(df_part, batch_num)
 
-                            os.remove(file_name)
-                            del df_part
-                            del table
-                        except Exception as e:
-                            logging.error(f'An error occurred while saving batch {batch_num}: {e}')
+            self.store_fingerprint_ids(df)
         except Exception as e:
             logging.error(f"An error occurred while computing and storing fingerprints: {e}")
         finally:
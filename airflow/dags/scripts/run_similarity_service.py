@@ -0,0 +1,14 @@
+import logging
+from similarity_query_service import SimilarityQueryService
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+
+def main():
+    service = SimilarityQueryService()
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
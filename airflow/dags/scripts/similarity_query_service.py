@@ -0,0 +1,405 @@
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rdkit.Chem import AllChem
+
+from aws import get_s3_client
+from config import CONFIG
+from exceptions import SMILESParsingError
+from morgan_fingerprint_calculator import MorganFingerprintCalculator
+from morgan_fingerprint_processor import MorganFingerprintProcessor
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """Number of set bits in every row of a packed uint8 fingerprint matrix."""
+    return POPCOUNT_TABLE[packed].sum(axis=-1, dtype=np.int32)
+
+
+class FingerprintLibrary:
+    """Packed, memory-mapped matrix of the unique library fingerprints.
+
+    Rows are sorted by popcount and stored column-major, one contiguous array per fingerprint byte,
+    so a query only reads the bytes in which it has bits set and only the rows whose popcount can
+    still beat its current top-k scores. row_chembl_ids lists the molecules that share each row.
+    """
+    # Tanimoto bounds of the successively wider popcount windows scanned for a query
+    SCORE_BOUNDS = (0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0)
+
+    def __init__(self, path, row_chembl_ids, popcounts, manifest_version):
+        self.path = path
+        self.row_chembl_ids = row_chembl_ids
+        self.popcounts = popcounts
+        self.manifest_version = manifest_version
+        self.row_index = {chembl_id: row for row, chembl_ids in enumerate(row_chembl_ids)
+                          for chembl_id in chembl_ids}
+        # First row of every popcount in the sorted rows
+        self.popcount_offsets = np.searchsorted(popcounts, np.arange(MorganFingerprintCalculator.FPS_BITS + 2))
+        if row_chembl_ids:
+            self.columns = np.memmap(path, dtype=np.uint8, mode='r', shape=(self.num_bytes(), len(row_chembl_ids)))
+        else:
+            self.columns = np.empty((self.num_bytes(), 0), dtype=np.uint8)
+
+    @staticmethod
+    def num_bytes():
+        return MorganFingerprintCalculator.FPS_BITS // 8
+
+    @staticmethod
+    def pack_bit_strings(bit_strings):
+        bits = np.frombuffer(''.join(bit_strings).encode('ascii'), dtype=np.uint8) - ord('0')
+        return np.packbits(bits.reshape(len(bit_strings), MorganFingerprintCalculator.FPS_BITS), axis=1)
+
+    @staticmethod
+    def read_parquet(s3, bucket_name, key):
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+        return pq.read_table(pa.BufferReader(obj['Body'].read())).to_pandas()
+
+    @classmethod
+    def write_columns(cls, rows_path, path, order, block_size):
+        """Rewrite the row-major shard dump in popcount order as one contiguous array per byte."""
+        rows = np.memmap(rows_path, dtype=np.uint8, mode='r', shape=(len(order), cls.num_bytes()))
+        columns = np.memmap(f'{path}.tmp', dtype=np.uint8, mode='w+', shape=(cls.num_bytes(), len(order)))
+        for start in range(0, len(order), block_size):
+            columns[:, start:start + block_size] = rows[order[start:start + block_size]].T
+        columns.flush()
+        del columns, rows
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def build(cls, s3, bucket_name, manifest, path, block_size=100000):
+        logging.info(f"Building fingerprint library version {manifest['version']} "
+                     f"from {len(manifest['shards'])} shards into {path}")
+        rows_path = f'{path}.rows'
+        fingerprint_ids = []
+        popcounts = []
+
+        with open(rows_path, 'wb') as file:
+            for key in manifest['shards']:
+                fp_df = cls.read_parquet(s3, bucket_name, key)
+                if fp_df.empty:
+                    continue
+                packed = cls.pack_bit_strings(fp_df['morgan_fingerprint'].tolist())
+                file.write(packed.tobytes())
+                fingerprint_ids.append(fp_df['fingerprint_id'].to_numpy())
+                popcounts.append(popcount(packed))
+                logging.info(f'Loaded {len(fp_df)} fingerprints from {key}')
+
+        fingerprint_ids = np.concatenate(fingerprint_ids) if fingerprint_ids else np.empty(0, dtype=np.int64)
+        popcounts = np.concatenate(popcounts) if popcounts else np.empty(0, dtype=np.int32)
+        order = np.argsort(popcounts, kind='stable')
+        if len(order):
+            cls.write_columns(rows_path, path, order, block_size)
+        os.remove(rows_path)
+
+        fingerprint_rows = {fingerprint_id: row for row, fingerprint_id in enumerate(fingerprint_ids[order].tolist())}
+        row_chembl_ids = [[] for _ in range(len(fingerprint_rows))]
+        fanout_df = cls.read_parquet(s3, bucket_name, manifest['fingerprint_ids'])
+        for chembl_id, fingerprint_id in zip(fanout_df['chembl_id'], fanout_df['fingerprint_id']):
+            row = fingerprint_rows.get(fingerprint_id)
+            if row is not None:
+                row_chembl_ids[row].append(chembl_id)
+
+        return cls(path, row_chembl_ids, popcounts[order], manifest['version'])
+
+    def __len__(self):
+        return len(self.row_chembl_ids)
+
+    def num_molecules(self):
+        return len(self.row_index)
+
+    def fingerprint(self, row):
+        return np.array(self.columns[:, row])
+
+    def score(self, query, query_popcount, start, stop, chunk_size):
+        """Tanimoto scores of the rows start:stop, reading only the bytes in which the query has bits set."""
+        query_bytes = np.flatnonzero(query)
+        scores = np.empty(stop - start, dtype=np.float64)
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            common = np.zeros(chunk_stop - chunk_start, dtype=np.int32)
+            masked = np.empty(chunk_stop - chunk_start, dtype=np.uint8)
+            counts = np.empty(chunk_stop - chunk_start, dtype=np.uint8)
+            for byte in query_bytes:
+                np.bitwise_and(self.columns[byte, chunk_start:chunk_stop], query[byte], out=masked)
+                common += np.take(POPCOUNT_TABLE, masked, out=counts, mode='clip')
+            union = self.popcounts[chunk_start:chunk_stop] + query_popcount - common
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores[chunk_start - start:chunk_stop - start] = np.where(union > 0, common / union, 0.0)
+        return scores
+
+    @staticmethod
+    def select_top(rows, scores, k):
+        """Keep the k best (row, score) pairs."""
+        if len(rows) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[keep], scores[keep]
+        return rows, scores
+
+    def search(self, query, k, chunk_size):
+        """Top-k rows of one query.
+
+        The popcount window is widened bound by bound; rows outside the window of a bound b score
+        below b, so the scan stops once the k-th best score reaches it.
+        """
+        query_popcount = int(popcount(query))
+        max_popcount = MorganFingerprintCalculator.FPS_BITS
+        rows = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float64)
+        low = high = self.popcount_offsets[query_popcount]
+
+        for bound in self.SCORE_BOUNDS:
+            min_count = max(int(np.ceil(query_popcount * bound - 1e-9)), 0)
+            max_count = min(int(np.floor(query_popcount / bound + 1e-9)), max_popcount) if bound else max_popcount
+            new_low, new_high = self.popcount_offsets[min_count], self.popcount_offsets[max_count + 1]
+            for start, stop in ((new_low, low), (high, new_high)):
+                if stop > start:
+                    rows, scores = self.select_top(
+                        np.concatenate([rows, np.arange(start, stop)]),
+                        np.concatenate([scores, self.score(query, query_popcount, start, stop, chunk_size)]), k)
+            low, high = new_low, new_high
+            if len(scores) >= k and scores.min() >= bound:
+                break
+
+        order = np.lexsort((rows, -scores))
+        return rows[order], scores[order]
+
+    def search_top_k(self, queries, ks, chunk_size):
+        """Top-k matches of every query in a batch, each scanning only its own popcount window."""
+        return [self.search(query, k, chunk_size) for query, k in zip(queries, ks)]
+
+
+class SimilarityQueryService:
+    """Resident top-k Tanimoto search over the fingerprint shards stored in S3.
+
+    Concurrent queries are queued and answered in batches by one worker; each
+    query only scans the popcount window that can still reach its top-k. The
+    library is rebuilt in the background whenever the fingerprint manifest
+    points to a new library version.
+    """
+
+    def __init__(self):
+        self.s3 = get_s3_client()
+        config = CONFIG.get_fingerprint_similarity_config()
+        self.service_config = config['service']
+        self.bucket_name = config['bucket_name']
+        self.manifest_key = config['fingerprints']['manifest_key']
+        self.cache_dir = self.service_config['cache_dir']
+        self.max_batch_size = self.service_config['max_batch_size']
+        self.scan_chunk_size = self.service_config['scan_chunk_size']
+        self.reload_interval = self.service_config['reload_interval']
+        self.timeout = self.service_config['timeout']
+        self.library = None
+        self.library_version = 0
+        self.library_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def reload_if_changed(self):
+        try:
+            manifest = MorganFingerprintProcessor.read_manifest(self.s3, self.bucket_name, self.manifest_key)
+            if manifest is None:
+                logging.warning(f'No fingerprint library has been published at {self.manifest_key}')
+                return False
+            if self.library is not None and manifest['version'] == self.library.manifest_version:
+                return False
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f'fingerprints_{self.library_version + 1}.bin')
+            library = FingerprintLibrary.build(self.s3, self.bucket_name, manifest, path, self.scan_chunk_size)
+
+            with self.library_lock:
+                previous, self.library = self.library, library
+                self.library_version += 1
+            if previous is not None:
+                os.remove(previous.path)
+
+            logging.info(f'Fingerprint library version {self.library_version} loaded: '
+                         f'{len(library)} unique fingerprints for {library.num_molecules()} molecules')
+            return True
+        except Exception as e:
+            logging.error(f'An error occurred while reloading the fingerprint library: {e}')
+            return False
+
+    def query_fingerprint(self, library, query):
+        if query.startswith('CHEMBL') and query in library.row_index:
+            return library.fingerprint(library.row_index[query])
+
+        fps = AllChem.GetMorganFingerprintAsBitVect(
+            MorganFingerprintCalculator.validate_smiles(query),
+            MorganFingerprintCalculator.FPS_MOL_RADIUS, nBits=MorganFingerprintCalculator.FPS_BITS)
+        return FingerprintLibrary.pack_bit_strings([fps.ToBitString()])[0]
+
+    def process_batch(self, batch):
+        with self.library_lock:
+            library = self.library
+
+        if library is None:
+            for _, _, future in batch:
+                future.set_exception(RuntimeError('Fingerprint library is not loaded yet'))
+            return
+
+        valid = []
+        fingerprints = []
+        for query, k, future in batch:
+            try:
+                fingerprints.append(self.query_fingerprint(library, query))
+                valid.append((query, k, future))
+            except Exception as e:
+                future.set_exception(e)
+
+        if not valid:
+            return
+
+        logging.info(f'Scanning {len(library)} fingerprints for a batch of {len(valid)} queries')
+        try:
+            candidates = library.search_top_k(np.vstack(fingerprints), [k for _, k, _ in valid],
+                                              self.scan_chunk_size)
+        except Exception as e:
+            for _, _, future in valid:
+                future.set_exception(e)
+            return
+
+        # k unique fingerprints always cover at least k molecules
+        for (query, k, future), (rows, scores) in zip(valid, candidates):
+            matches = [{'chembl_id': chembl_id, 'tanimoto_similarity_score': float(score)}
+                       for row, score in zip(rows, scores) for chembl_id in library.row_chembl_ids[row]]
+            future.set_result(matches[:k])
+
+    def batch_worker(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.requests.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                logging.error(f'An error occurred while processing a batch of similarity queries: {e}')
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def reload_worker(self):
+        while not self.stop_event.wait(self.reload_interval):
+            self.reload_if_changed()
+
+    def submit(self, query, k=10):
+        future = Future()
+        self.requests.put((query.strip(), k, future))
+        return future
+
+    def search(self, queries, k=10):
+        futures = [self.submit(query, k) for query in queries]
+        results = {}
+        for query, future in zip(queries, futures):
+            try:
+                results[query] = future.result(timeout=self.timeout)
+            except SMILESParsingError as e:
+                logging.warning(f'Skipping query {query}: {e}')
+        return results
+
+    def start(self):
+        self.reload_if_changed()
+        self.threads = [threading.Thread(target=self.batch_worker, daemon=True),
+                        threading.Thread(target=self.reload_worker, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def serve_forever(self):
+        self.start()
+        server = ThreadingHTTPServer((self.service_config['bind_host'], self.service_config['port']),
+                                     self.make_handler())
+        logging.info(f'Similarity query service listening on {self.service_config["bind_host"]}:'
+                     f'{self.service_config["port"]}')
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.stop()
+
+    def make_handler(self):
+        service = self
+
+        class SimilarityRequestHandler(BaseHTTPRequestHandler):
+            def send_json(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_search(self, queries, k):
+                try:
+                    self.send_json(200, {'library_version': service.library_version,
+                                         'results': service.search(queries, k)})
+                except Exception as e:
+                    logging.error(f'An error occurred while answering similarity queries: {e}')
+                    self.send_json(503, {'error': str(e)})
+
+            @staticmethod
+            def parse_k(value):
+                k = int(value)
+                if k <= 0:
+                    raise ValueError(f'k must be a positive integer, got {value}')
+                return k
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/health':
+                    self.send_json(200, {'library_version': service.library_version,
+                                         'molecules': service.library.num_molecules() if service.library else 0})
+                elif url.path == '/similarity':
+                    params = parse_qs(url.query)
+                    try:
+                        k = self.parse_k(params.get('k', [10])[0])
+                    except ValueError as e:
+                        self.send_json(400, {'error': f'Invalid k: {e}'})
+                        return
+                    self.handle_search(params.get('q', []), k)
+                else:
+                    self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+            def do_POST(self):
+                if urlparse(self.path).path != '/similarity':
+                    self.send_json(404, {'error': f'Unknown path {self.path}'})
+                    return
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    queries = payload.get('queries', [])
+                    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                        raise ValueError('queries must be a list of strings')
+                    k = self.parse_k(payload.get('k', 10))
+                except (ValueError, TypeError, AttributeError) as e:
+                    self.send_json(400, {'error': f'Invalid request body: {e}'})
+                    return
+                self.handle_search(queries, k)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        return SimilarityRequestHandler
@@ -0,0 +1,24 @@
+import json
+import logging
+from urllib.request import Request
+from urllib.request import urlopen
+
+from config import CONFIG
+from exceptions import SimilarityServiceError
+
+
+class SimilarityServiceClient:
+    def __init__(self):
+        service_config = CONFIG.get_fingerprint_similarity_config()['service']
+        self.base_url = f"http://{service_config['host']}:{service_config['port']}"
+        self.timeout = service_config['timeout']
+
+    def search(self, queries, k=10):
+        logging.info(f'Sending {len(queries)} queries to the similarity service at {self.base_url}')
+        body = json.dumps({'queries': list(queries), 'k': k}).encode('utf-8')
+        request = Request(f'{self.base_url}/similarity', data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())['results']
+        except (OSError, ValueError, KeyError) as e:
+            raise SimilarityServiceError(f'Similarity service at {self.base_url} failed: {e}') from e
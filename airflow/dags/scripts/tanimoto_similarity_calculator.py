@@ -7,16 +7,10 @@ from rdkit.Chem import AllChem
 from rdkit.DataStructs import CreateFromBitString
 from rdkit.DataStructs import TanimotoSimilarity
 
-from aws import AWS
-from config import CONFIG
+from aws import get_s3_client
 from exceptions import SMILESParsingError
 from morgan_fingerprint_calculator import MorganFingerprintCalculator
 
-aws = AWS()
-s3 = aws.boto_client
-config = CONFIG.get_fingerprint_similarity_config()
-bucket_name = config['bucket_name']
-
 
 class TanimotoSimilarityCalculator:
 
@@ -31,7 +25,7 @@ class TanimotoSimilarityCalculator:
 
         try:
             logging.info(f'Reading fingerprint file {parquet_file}')
-            fp_obj = s3.get_object(Bucket=bucket_name, Key=parquet_file)
+            fp_obj = get_s3_client().get_object(Bucket=bucket_name, Key=parquet_file)
             fp_df = pq.read_table(pa.BufferReader(fp_obj['Body'].read())).to_pandas()
             fp_df['morgan_fingerprint'] = fp_df['morgan_fingerprint'].apply(CreateFromBitString)
         except Exception as e:
@@ -45,7 +39,7 @@ class TanimotoSimilarityCalculator:
                     MorganFingerprintCalculator.FPS_MOL_RADIUS, nBits=MorganFingerprintCalculator.FPS_BITS)
                 similarity_scores = fp_df.apply(
                     lambda x: cls.calculate_tanimoto_similarity(target_fps, x['morgan_fingerprint']), axis=1)
-                temp_df = fp_df[['chembl_id']].copy()
+                temp_df = fp_df[['fingerprint_id']].copy()
                 temp_df['tanimoto_similarity_score'] = similarity_scores
                 temp_df['target_chembl_id'] = row['molecule name']
                 results.append(temp_df)
@@ -1,6 +1,10 @@
 import gc
+import io
 import logging
 import os
+import re
+from datetime import date
+from datetime import timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
@@ -9,15 +13,19 @@ import pyarrow.parquet as pq
 from sqlmodel import Session
 from sqlmodel import select
 
-from aws import AWS
+from aws import get_s3_client
+from compact_similarity_store import CompactSimilarityStore
 from config import CONFIG
-from db import Database
+from db import get_engine
+from exceptions import SimilarityServiceError
 from models import (
     CompoundProperties,
     DimMolecules,
     FactMoleculeSimilarities,
     MoleculeDictionary
 )
+from morgan_fingerprint_processor import MorganFingerprintProcessor
+from similarity_service_client import SimilarityServiceClient
 from tanimoto_similarity_calculator import TanimotoSimilarityCalculator
 
 # Configure logging
@@ -26,32 +34,84 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(me
 
 class TanimotoSimilarityProcessor:
     def __init__(self):
-        db = Database()
-        aws = AWS()
-        self.engine = db.engine
-        self.s3 = aws.boto_client
+        self.engine = get_engine()
+        self.s3 = get_s3_client()
         config = CONFIG.get_fingerprint_similarity_config()
         self.bucket_name = config['bucket_name']
         self.input_prefix = config['input_prefix']
         self.similarities_prefix = config['similarities']['similarities_prefix']
-        self.fingerprints_prefix = config['fingerprints']['fingerprints_prefix']
+        self.output_mode = config['similarities']['output_mode']
+        self.manifest_key = config['fingerprints']['manifest_key']
+        self.service_top_k = config['service']['top_k']
 
-    def compute_and_store_similarity(self, file_key):
+    def read_target_molecules(self, file_key):
+        try:
+            file_obj = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
+            df = pd.read_csv(file_obj['Body'], encoding='utf-8', on_bad_lines='skip')
+            df.columns = [col.lower() for col in df.columns]
+        except (pd.errors.ParserError, UnicodeDecodeError) as e:
+            logging.error(f"Error reading file {file_key}: {e}")
+            return None
+
+        return df[df['molecule name'].apply(lambda x: x.startswith('CHEMBL'))]
+
+    @staticmethod
+    def select_top_10(group):
+        top_10_df = group.nlargest(10, 'tanimoto_similarity_score').reset_index(drop=True)
+        top_10_df['has_duplicates_of_last_largest_score'] = top_10_df.duplicated(
+            subset=['tanimoto_similarity_score'], keep=False)
+        top_10_df.rename(columns={'chembl_id': 'source_chembl_id'}, inplace=True)
+        return top_10_df
+
+    def read_fingerprint_ids(self, manifest):
+        file_obj = self.s3.get_object(Bucket=self.bucket_name, Key=manifest['fingerprint_ids'])
+        return pq.read_table(pa.BufferReader(file_obj['Body'].read())).to_pandas()
+
+    @staticmethod
+    def expand_fingerprint_ids(results, fingerprint_ids):
+        """Fan scores of unique fingerprints out to every molecule sharing that fingerprint."""
+        expanded = results.merge(fingerprint_ids, on='fingerprint_id')
+        return expanded[['chembl_id', 'tanimoto_similarity_score', 'target_chembl_id']]
+
+    @classmethod
+    def expand_top_fingerprints(cls, group, fingerprint_ids, fanout_counts, n=10):
+        """Expand only the best unique fingerprints needed to cover the top n molecules.
+
+        Every fingerprint tied with the score at which n molecules are reached is kept, so the top n
+        and its duplicate-score flag are the same as when every molecule is scored separately.
+        """
+        group = group.sort_values('tanimoto_similarity_score', ascending=False)
+        covered = group['fingerprint_id'].map(fanout_counts).fillna(0).cumsum()
+        reached = covered >= n
+        if reached.any():
+            cutoff = group.loc[reached, 'tanimoto_similarity_score'].iloc[0]
+            group = group[group['tanimoto_similarity_score'] >= cutoff]
+        return cls.expand_fingerprint_ids(group, fingerprint_ids)
+
+    @staticmethod
+    def parse_load_month(file_key, load_month=None):
+        """First day of the month being loaded, taken from the DAG or from the data_MM_YYYY file name."""
+        if load_month is not None:
+            return date.fromisoformat(str(load_month)).replace(day=1)
+        match = re.search(r'(\d{2})_(\d{4})', os.path.basename(file_key))
+        if match:
+            return date(int(match.group(2)), int(match.group(1)), 1)
+        return date.today().replace(day=1)
+
+    def compute_and_store_similarity(self, file_key, load_month=None):
         try:
             logging.info(f'Processing file {file_key}')
-            try:
-                file_obj = self.s3.get_object(Bucket=self.bucket_name, Key=file_key)
-                df = pd.read_csv(file_obj['Body'], encoding='utf-8', on_bad_lines='skip')
-                df.columns = [col.lower() for col in df.columns]
-            except (pd.errors.ParserError, UnicodeDecodeError) as e:
-                logging.error(f"Error reading file {file_key}: {e}")
+            df = self.read_target_molecules(file_key)
+            if df is None:
                 return
 
-            df = df[df['molecule name'].apply(lambda x: x.startswith('CHEMBL'))]
-
-            parquet_files = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=self.fingerprints_prefix).get(
-                'Contents', [])
-            parquet_files = [file['Key'] for file in parquet_files if file['Key'].endswith('.parquet')]
+            # Shards and fan-out table are taken from the same published version of the library
+            manifest = MorganFingerprintProcessor.read_manifest(self.s3, self.bucket_name, self.manifest_key)
+            if manifest is None:
+                logging.error(f"No fingerprint library has been published at {self.manifest_key}.")
+                return
+            logging.info(f"Using fingerprint library version {manifest['version']}")
+            parquet_files = manifest['shards']
 
             combined_results = []
             num_cores = 4
@@ -68,27 +128,46 @@ class TanimotoSimilarityProcessor:
                         logging.error(f"Error processing batch: {e}")
 
             combined_results = pd.concat(combined_results, ignore_index=True)
-            logging.info(f'Number of records in combined results: {len(combined_results)}')
+            logging.info(f'Number of unique fingerprint scores in combined results: {len(combined_results)}')
 
             if 'target_chembl_id' in combined_results.columns:
+                fingerprint_ids = self.read_fingerprint_ids(manifest)
+                fanout_counts = fingerprint_ids['fingerprint_id'].value_counts()
+
+                # Compact mode streams every target group into the run's dataset in target order
+                compact_store = None
+                if self.output_mode == 'compact':
+                    compact_store = CompactSimilarityStore(self.s3, self.bucket_name)
+                    compact_store.start(os.path.splitext(os.path.basename(file_key))[0], fingerprint_ids)
+
                 top_10_df_union = pd.DataFrame()
-                for molecule_name, group in combined_results.groupby('target_chembl_id'):
-                    logging.info(f'Processing and saving molecule {molecule_name}')
-                    output_file_name = f"similarity_{molecule_name}.parquet"
-                    output_file_path = f'{self.similarities_prefix}{output_file_name}'
-                    pq.write_table(pa.Table.from_pandas(group), output_file_name, compression='zstd')
-                    self.s3.upload_file(output_file_name, self.bucket_name, output_file_path)
-                    logging.info(f'File uploaded to S3: {output_file_path}')
-                    os.remove(output_file_name)
-
-                    top_10_df = group.nlargest(10, 'tanimoto_similarity_score').reset_index(drop=True)
-                    top_10_df['has_duplicates_of_last_largest_score'] = top_10_df.duplicated(
-                        subset=['tanimoto_similarity_score'], keep=False)
-                    top_10_df.rename(columns={'chembl_id': 'source_chembl_id'}, inplace=True)
-                    top_10_df_union = pd.concat([top_10_df_union, top_10_df])
+                try:
+                    for molecule_name, group in combined_results.groupby('target_chembl_id'):
+                        logging.info(f'Processing and saving molecule {molecule_name}')
+                        if compact_store is not None:
+                            compact_store.append(molecule_name, group)
+                        else:
+                            output_file_name = f"similarity_{molecule_name}.parquet"
+                            output_file_path = f'{self.similarities_prefix}{output_file_name}'
+                            expanded_group = self.expand_fingerprint_ids(group, fingerprint_ids)
+                            pq.write_table(pa.Table.from_pandas(expanded_group), output_file_name, compression='zstd')
+                            self.s3.upload_file(output_file_name, self.bucket_name, output_file_path)
+                            logging.info(f'File uploaded to S3: {output_file_path}')
+                            os.remove(output_file_name)
+
+                        top_10_df = self.select_top_10(
+                            self.expand_top_fingerprints(group, fingerprint_ids, fanout_counts))
+                        top_10_df_union = pd.concat([top_10_df_union, top_10_df])
+
+                    if compact_store is not None:
+                        compact_store.publish()
+                except Exception:
+                    if compact_store is not None:
+                        compact_store.discard()
+                    raise
 
                 top_10_df_union.drop_duplicates(inplace=True)
-                self.insert_to_data_mart(top_10_df_union)
+                self.insert_to_data_mart(top_10_df_union, self.parse_load_month(file_key, load_month))
             else:
                 logging.warning(f"'target_chembl_id' column missing in combined results for file {file_key}.")
 
@@ -99,16 +178,50 @@ class TanimotoSimilarityProcessor:
         finally:
             gc.collect()
 
-    def insert_to_data_mart(self, top_10_df):
+    def compute_and_store_similarity_from_service(self, file_key, load_month=None):
+        """Query the resident similarity service for the top matches instead of scanning every shard.
+
+        Only the top matches are returned by the service, so the per-target similarity files are not
+        written in this mode. SimilarityServiceError is raised when the service cannot be reached.
+        """
+        try:
+            logging.info(f'Processing file {file_key} with the similarity service')
+            df = self.read_target_molecules(file_key)
+            if df is None:
+                return
+
+            targets = df.groupby('smiles')['molecule name'].apply(list).to_dict()
+            results = SimilarityServiceClient().search(list(targets), k=self.service_top_k)
+
+            top_10_dfs = []
+            for smiles, matches in results.items():
+                for molecule_name in targets[smiles]:
+                    group = pd.DataFrame(matches, columns=['chembl_id', 'tanimoto_similarity_score'])
+                    group['target_chembl_id'] = molecule_name
+                    top_10_dfs.append(self.select_top_10(group))
+
+            if not top_10_dfs:
+                logging.warning(f'No similarity results returned for file {file_key}.')
+                return
+
+            top_10_df_union = pd.concat(top_10_dfs)
+            top_10_df_union.drop_duplicates(inplace=True)
+            self.insert_to_data_mart(top_10_df_union, self.parse_load_month(file_key, load_month))
+            logging.info(f'File {file_key} processed.')
+        except SimilarityServiceError:
+            raise
+        except Exception as e:
+            logging.error(f"An error occurred during the similarity service lookup: {e}")
+        finally:
+            gc.collect()
+
+    def insert_to_data_mart(self, top_10_df, load_month):
         try:
             with Session(self.engine) as session:
-                logging.info("Fetching existing chembl_id values from fact_molecule_similarities table...")
+                logging.info("Fetching existing chembl_id values from dim_molecules table...")
                 existing_chembl_ids = session.exec(select(DimMolecules.chembl_id)).all()
                 existing_chembl_ids_set = {row for row in existing_chembl_ids}
 
-                logging.info("Filtering top_10_df to exclude existing chembl_id")
-                top_10_df = top_10_df[~top_10_df['source_chembl_id'].isin(existing_chembl_ids_set)]
-
                 logging.info("Inserting data into dim_molecules table")
                 unique_source_chembl_id = set(top_10_df['source_chembl_id'])
                 unique_target_chembl_id = set(top_10_df['target_chembl_id'])
@@ -140,12 +253,59 @@ class TanimotoSimilarityProcessor:
                 dim_molecules_df.drop_duplicates(subset=['chembl_id'], inplace=True)
                 dim_molecules_df.to_sql(DimMolecules.__tablename__, con=self.engine, if_exists='append', index=False)
 
-                logging.info("Inserting data into fact_molecule_similarities table")
-                top_10_df.to_sql(FactMoleculeSimilarities.__tablename__, con=self.engine, if_exists='append',
-                                 index=False)
+                self.load_fact_partition(top_10_df, load_month)
 
                 logging.info("Data successfully inserted into dim_molecules and fact_molecule_similarities tables.")
         except Exception as e:
             logging.error(f"An error occurred during insertion: {e}")
         finally:
             gc.collect()
+
+    def load_fact_partition(self, top_10_df, load_month):
+        """Bulk-load one month into a standalone table and swap it in as that month's partition.
+
+        The table is filled with COPY and indexed before it is attached, so the fact table never sees
+        row-by-row inserts. Reprocessing a month replaces its partition in a single transaction.
+        """
+        table = FactMoleculeSimilarities.__tablename__
+        partition = f'{table}_{load_month:%Y_%m}'
+        staging = f'{partition}_load'
+        next_month = (load_month.replace(day=28) + timedelta(days=4)).replace(day=1)
+        columns = ['load_month', 'source_chembl_id', 'target_chembl_id', 'tanimoto_similarity_score',
+                   'has_duplicates_of_last_largest_score']
+
+        buffer = io.StringIO()
+        top_10_df.assign(load_month=load_month)[columns].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                logging.info(f"Bulk loading {len(top_10_df)} rows into {staging}")
+                cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+                cursor.execute(f"CREATE TABLE {staging} (LIKE {table} INCLUDING DEFAULTS)")
+                cursor.copy_expert(f"COPY {staging} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cursor.execute(f"ALTER TABLE {staging} ADD PRIMARY KEY "
+                               f"(load_month, source_chembl_id, target_chembl_id)")
+                # Lets ATTACH PARTITION skip scanning the table to check the partition bound
+                cursor.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {partition}_load_month_check "
+                               f"CHECK (load_month >= %s AND load_month < %s)", (load_month, next_month))
+            connection.commit()
+
+            with connection.cursor() as cursor:
+                logging.info(f"Swapping partition {partition} of {table}")
+                cursor.execute("SELECT to_regclass(%s)", (partition,))
+                if cursor.fetchone()[0] is not None:
+                    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+                    cursor.execute(f"DROP TABLE {partition}")
+                cursor.execute(f"ALTER TABLE {staging} RENAME TO {partition}")
+                cursor.execute(f"ALTER INDEX {staging}_pkey RENAME TO {partition}_pkey")
+                cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)",
+                               (load_month, next_month))
+            connection.commit()
+            logging.info(f"Partition {partition} attached to {table}")
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()